@@ -1,30 +1,117 @@
+import functools
+import importlib.util
+import io
 import os
 import platform
-import re
 import subprocess
-from time import sleep
+from typing import TYPE_CHECKING
 from tqdm import tqdm
-from pytubefix import YouTube, Playlist
-from pytubefix.cli import on_progress
-import io
 import shutil
 
+import queue
+from urllib.parse import parse_qs, urlparse
 import tempfile
 import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# pytubefix is imported where it's used, so startup doesn't pay for its dependency tree
+if TYPE_CHECKING:
+    from pytubefix import YouTube
+
+PIPE_CHUNK_SIZE = 256 * 1024  # Bytes handed to an ffmpeg stdin pipe per write
+RANGE_REQUEST_SIZE = 16 * 1024 * 1024  # Bytes per HTTP range request, held in memory whole; pytubefix defaults to ~9MB
+_SANITIZE_TABLE = str.maketrans('', '', '\\/*?:"<>|#')  # Characters not allowed in filenames
+
+_PRINT_LOCK = threading.Lock()
+
+
+def _log(message: str):
+    """Prints a line from any worker thread without breaking active tqdm progress bars."""
+    with _PRINT_LOCK:
+        tqdm.write(message)
+
+
+def _env_int(name: str, default: int) -> int:
+    """Reads a positive integer setting from the environment, falling back to the default."""
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number < 1:
+        print(f"Warning: {name} must be a positive integer, got {value!r}. Using {default}.")
+        return default
+    return number
+
+
+def _is_playlist_url(url: str) -> bool:
+    """True for playlist pages (/playlist?list=...), not for watch links that merely carry a list= parameter."""
+    parsed = urlparse(url)
+    return parsed.path.rstrip('/') == '/playlist' and 'list' in parse_qs(parsed.query)
+
+
+@functools.cache
+def _pytubefix():
+    """Imports pytubefix on first use and applies the download tuning once."""
+    import pytubefix
+    import pytubefix.cli
+    from pytubefix import request
+
+    # Fewer, larger range requests cut the per-request round trips on long videos
+    request.default_range_size = RANGE_REQUEST_SIZE
+    return pytubefix
+
+
+class _PipeWriter:
+    """File-like wrapper that feeds a pipe in fixed-size slices so the kernel can apply backpressure.
+
+    Pipes can't seek: tell() reports the bytes written so far, and seek() only accepts the current position.
+    """
+
+    def __init__(self, pipe):
+        self._pipe = pipe
+        self._written = 0
+
+    def write(self, data) -> int:
+        view = memoryview(data)
+        for start in range(0, len(view), PIPE_CHUNK_SIZE):
+            self._pipe.write(view[start:start + PIPE_CHUNK_SIZE])
+        self._written += len(view)
+        return len(view)
+
+    def flush(self):
+        self._pipe.flush()
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if (whence, offset) in ((io.SEEK_SET, self._written), (io.SEEK_CUR, 0)):
+            return self._written
+        raise io.UnsupportedOperation("cannot seek a pipe away from its current position")
+
+    def tell(self) -> int:
+        return self._written
+
 
 class YouTubeDownloader:
     def __init__(self):
         self.path = os.path.expanduser('~/Downloads')
         os.makedirs(self.path, exist_ok=True)
         self.mode = 'S'  # Default mode is Sound
+        self.max_parallel = _env_int("YTDL_JOBS", 4)  # Concurrent playlist downloads
+        # Shared merge workers so parallel playlist downloads queue up instead of all running ffmpeg at once
+        self._ffmpeg_pool = ThreadPoolExecutor(max_workers=_env_int("YTDL_FFMPEG_JOBS", 2), thread_name_prefix="ffmpeg")
+        # Resolved once rather than per video
+        self._ffmpeg = shutil.which("ffmpeg")
+        self._video_codec = 'h264_videotoolbox' if platform.system() == 'Darwin' else 'libx264'
 
     def _sanitize_filename(self, title: str) -> str:
         """Removes illegal characters from a string so it can be a valid filename."""
-        return re.sub(r'[\\/*?:"<>|#]', "", title)
+        return title.translate(_SANITIZE_TABLE)
 
     def _check_dependencies(self):
         # Check for ffmpeg
-        if not shutil.which("ffmpeg"):
+        if self._ffmpeg is None:
             print("\nError: ffmpeg is not installed or not in your PATH.")
             print("Please install ffmpeg to use this script.")
             print("  - On macOS (with Homebrew): brew install ffmpeg")
@@ -33,41 +120,35 @@ class YouTubeDownloader:
             if input("Do you want to exit? (y/n): ").lower() == 'y':
                 exit()
 
-        # Check for pytubefix and tqdm
-        missing_packages = []
-        try:
-            import pytubefix
-        except ImportError:
-            missing_packages.append('pytubefix')
-        try:
-            import tqdm
-        except ImportError:
-            missing_packages.append('tqdm')
-
-        if missing_packages:
-            print(f"\nError: The following Python packages are not installed: {', '.join(missing_packages)}")
-            print(f"Please install them using pip: pip install {' '.join(missing_packages)}")
+        # Check for pytubefix without importing it yet
+        if importlib.util.find_spec('pytubefix') is None:
+            print("\nError: The Python package pytubefix is not installed.")
+            print("Please install it using pip: pip install pytubefix")
             if input("Do you want to exit? (y/n): ").lower() == 'y':
                 exit()
 
-    def _download_video(self, url: str, lang: str = 'ko'):
-        """Downloads a single video or converts audio directly to MP3."""
+    def _download_video(self, video: "str | YouTube", lang: str = 'ko', show_progress: bool = True):
+        """Downloads a single video (URL or prefetched YouTube object) or converts audio directly to MP3.
+
+        show_progress draws pytubefix's per-stream bar for URLs; playlist workers turn it off because
+        that bar writes to stdout directly and would draw over the shared tqdm bars.
+        """
+        caption_thread = None
         try:
-            yt = YouTube(url, on_progress_callback=on_progress)
+            pytubefix = _pytubefix()
+            if isinstance(video, pytubefix.YouTube):
+                yt = video
+            elif show_progress:
+                yt = pytubefix.YouTube(video, on_progress_callback=pytubefix.cli.on_progress)
+            else:
+                yt = pytubefix.YouTube(video)
             title = self._sanitize_filename(yt.title)
-            print(f"\nProcessing: {yt.title}")
-            print(f"Sanitized Title: {title}")
+            _log(f"\nProcessing: {yt.title}")
+            _log(f"Sanitized Title: {title}")
 
-            # Caption download logic remains the same
-            try:
-                if lang in yt.captions:
-                    caption = yt.captions[lang]
-                    caption.download(title=title, output_path=self.path)
-                    print("Captions downloaded.")
-                else:
-                    print(f"No captions available for language code: {lang}")
-            except Exception as e:
-                print(f"Could not download captions: {e}")
+            # Captions are small and independent, so fetch them off the critical path
+            caption_thread = threading.Thread(target=self._download_captions, args=(yt, title, lang), daemon=True)
+            caption_thread.start()
 
             if self.mode == 'V':
                 # Get the highest resolution video stream (may be adaptive)
@@ -76,83 +157,77 @@ class YouTubeDownloader:
                 audio_stream = yt.streams.get_audio_only()
 
                 if not video_stream:
-                    print("No video stream found.")
+                    _log("No video stream found.")
                     return
                 if not audio_stream:
-                    print("No audio stream found.")
+                    _log("No audio stream found.")
                     return
 
-                temp_dir = os.path.join(self.path, '.temp')
-                os.makedirs(temp_dir, exist_ok=True)
-
-                print(f"Downloading video stream ({video_stream.resolution})...")
-                video_filepath = video_stream.download(output_path=temp_dir, filename=f"{title}_video.mp4")
-                print("Video stream download complete.")
-
-                print("Downloading audio stream...")
-                audio_filepath = audio_stream.download(output_path=temp_dir, filename=f"{title}_audio.mp4")
-                print("Audio stream download complete.")
-
-                output_filepath = os.path.join(self.path, f"{title}.mp4")
-
-                print("Merging video and audio streams with ffmpeg...")
-                progress_file = tempfile.NamedTemporaryFile(delete=False, mode='w+', encoding='utf-8')
-                video_codec = 'h264_videotoolbox' if platform.system() == 'Darwin' else 'libx264'
-                command = [
-                    'ffmpeg',
-                    '-y', # Overwrite output file if it exists
-                    '-nostdin',
-                    '-progress', progress_file.name,
-                    '-i', video_filepath,
-                    '-i', audio_filepath,
-                    '-c:v', video_codec,
-                    '-pix_fmt', 'yuv420p', # Set pixel format for broader compatibility
-                    '-c:a', 'aac', # Re-encode audio to aac for broader compatibility
-                    '-strict', 'experimental', # Needed for aac encoding
-                    output_filepath
-                ]
-
-                total_duration = yt.length # Get total video duration in seconds
+                # Private temp dir per video, so parallel playlist workers never collide on filenames
+                temp_dir = tempfile.mkdtemp(prefix='ytdl_')
 
                 try:
-                    with tqdm(total=total_duration, unit="s", desc="FFmpeg Progress") as pbar:
-                        progress_thread = threading.Thread(target=self._update_ffmpeg_progress, args=(pbar, progress_file.name))
-                        progress_thread.start()
-
-                        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                        process.wait()
-
-                        progress_thread.join()
-
-                    if process.returncode == 0:
-                        print(f"Successfully merged and saved to {output_filepath}")
+                    # The two streams are independent fetches into separate files, so run them side by side
+                    _log(f"Downloading video ({video_stream.resolution}) and audio streams...")
+                    with ThreadPoolExecutor(max_workers=2) as executor:
+                        video_future = executor.submit(video_stream.download, output_path=temp_dir, filename=f"{title}_video.mp4")
+                        audio_future = executor.submit(audio_stream.download, output_path=temp_dir, filename=f"{title}_audio.mp4")
+                        video_filepath = video_future.result()
+                        audio_filepath = audio_future.result()
+                    _log("Video and audio stream downloads complete.")
+
+                    output_filepath = os.path.join(self.path, f"{title}.mp4")
+
+                    _log("Merging video and audio streams with ffmpeg...")
+                    # H.264 video and AAC audio are remuxed as-is; anything else is re-encoded for broader compatibility
+                    if (video_stream.video_codec or '').startswith('avc1'):
+                        video_args = ['-c:v', 'copy']
+                    else:
+                        # -threads 0 lets libx264 use every core; h264_videotoolbox ignores it harmlessly
+                        video_args = ['-c:v', self._video_codec, '-pix_fmt', 'yuv420p', '-threads', '0']
+                    if (audio_stream.audio_codec or '').startswith('mp4a'):
+                        audio_args = ['-c:a', 'copy']
+                    else:
+                        audio_args = ['-c:a', 'aac', '-b:a', '192k']
+                    command = [
+                        self._ffmpeg,
+                        '-y', # Overwrite output file if it exists
+                        '-nostdin',
+                        '-progress', 'pipe:1', # Progress key=value lines on stdout
+                        '-i', video_filepath,
+                        '-i', audio_filepath,
+                        '-map', '0:v:0',
+                        '-map', '1:a:0',
+                        *video_args,
+                        *audio_args,
+                        '-movflags', '+faststart', # Put the moov atom up front so the file is seekable while streaming
+                        output_filepath
+                    ]
+
+                    total_duration = yt.length # Get total video duration in seconds
+
+                    returncode, stderr = self._ffmpeg_pool.submit(self._run_ffmpeg_merge, command, total_duration).result()
+
+                    if returncode == 0:
+                        _log(f"Successfully merged and saved to {output_filepath}")
                     else:
-                        print(f"Error during ffmpeg merging: {process.stderr.read().decode('utf-8', errors='ignore')}")
+                        _log(f"Error during ffmpeg merging: {stderr.decode('utf-8', errors='ignore')}")
 
                 except Exception as e:
-                    print(f"An error occurred during ffmpeg process: {e}")
+                    _log(f"An error occurred while downloading or merging streams: {e}")
                 finally:
-                    progress_file.close()
-                    os.unlink(progress_file.name)
-                    # Clean up temporary files
-                    if os.path.exists(video_filepath):
-                        os.remove(video_filepath)
-                    if os.path.exists(audio_filepath):
-                        os.remove(audio_filepath)
-                    print("Temporary files cleaned up.")
+                    # Removes both intermediate streams, even if a download failed partway
+                    shutil.rmtree(temp_dir, ignore_errors=True)
+                    _log("Temporary files cleaned up.")
             
             elif self.mode == 'S':
                 stream = yt.streams.get_audio_only()
-                print("Streaming audio to ffmpeg for MP3 conversion...")
-                
-                audio_buffer = io.BytesIO()
-                stream.stream_to_buffer(buffer=audio_buffer)
-                audio_buffer.seek(0) # Rewind buffer to the beginning
+                _log("Streaming audio to ffmpeg for MP3 conversion...")
 
                 mp3_file_path = os.path.join(self.path, f"{title}.mp3")
 
                 command = [
-                    'ffmpeg',
+                    self._ffmpeg,
                     '-i', 'pipe:0',      # Input from stdin
                     '-vn',               # No video
                     '-b:a', '192k',      # Audio bitrate
@@ -163,63 +238,158 @@ class YouTubeDownloader:
                 total_duration = yt.length # Get total video duration in seconds
 
                 try:
-                    process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                    stdout, stderr = process.communicate(input=audio_buffer.read())
-
-                    if process.returncode == 0:
-                        print(f"Successfully created {title}.mp3")
+                    # Start ffmpeg before the download so encoding overlaps with it chunk by chunk
+                    process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+                    # Download into ffmpeg's stdin on a writer thread while this thread drains stderr,
+                    # avoiding the deadlock a full stderr pipe would cause without communicate()
+                    with ThreadPoolExecutor(max_workers=1) as executor:
+                        writer_future = executor.submit(self._pipe_stream_to_process, stream, process)
+                        stderr = process.stderr.read()
+                        download_error = writer_future.result()
+                    process.wait()
+
+                    if download_error is not None:
+                        # ffmpeg happily encodes a truncated input, so don't keep what it produced
+                        _log(f"An error occurred while streaming audio: {download_error}")
+                        if os.path.exists(mp3_file_path):
+                            os.remove(mp3_file_path)
+                    elif process.returncode == 0:
+                        _log(f"Successfully created {title}.mp3")
                     else:
-                        print(f"Error during ffmpeg conversion: {stderr.decode('utf-8', errors='ignore')}")
+                        _log(f"Error during ffmpeg conversion: {stderr.decode('utf-8', errors='ignore')}")
 
                 except Exception as e:
-                    print(f"An error occurred during ffmpeg conversion: {e}")
+                    _log(f"An error occurred during ffmpeg conversion: {e}")
         except Exception as err:
-            print(f"An error occurred during video processing: {err}")
+            _log(f"An error occurred during video processing: {err}")
+        finally:
+            if caption_thread is not None:
+                caption_thread.join()
+
+    def _download_captions(self, yt, title: str, lang: str):
+        """Downloads captions for the given language next to the media file, if available."""
+        try:
+            if lang in yt.captions:
+                caption = yt.captions[lang]
+                caption.download(title=title, output_path=self.path)
+                message = "Captions downloaded."
+            else:
+                message = f"No captions available for language code: {lang}"
+        except Exception as e:
+            message = f"Could not download captions: {e}"
+        _log(message)
 
     
 
     
 
-    def _update_ffmpeg_progress(self, pbar, progress_file_name):
-        with open(progress_file_name, 'r') as f:
-            while True:
-                line = f.readline()
-                if not line:
-                    sleep(0.1)
-                    continue
-                if "progress=end" in line:
-                    break
-                if "out_time_ms=" in line:
-                    parts = line.split("=")
-                    if len(parts) > 1:
-                        try:
-                            time_ms = int(parts[1])
-                            current_time_seconds = time_ms / 1_000_000
-                            pbar.update(current_time_seconds - pbar.n)
-                        except ValueError:
-                            pass # Ignore lines that don't have a valid time
+    def _run_ffmpeg_merge(self, command, total_duration):
+        """Runs one ffmpeg merge job with a progress bar and returns its exit code and stderr."""
+        with tqdm(total=total_duration, unit="s", desc="FFmpeg Progress") as pbar:
+            process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+            progress_thread = threading.Thread(target=self._update_ffmpeg_progress, args=(pbar, process.stdout))
+            progress_thread.start()
+
+            # Drain stderr while ffmpeg runs; a full pipe would otherwise block it forever
+            stderr = process.stderr.read()
+            process.wait()
+
+            progress_thread.join()
+
+        return process.returncode, stderr
+
+    def _pipe_stream_to_process(self, stream, process):
+        """Writes a stream's bytes into a process's stdin, closing it when done.
+
+        Returns the exception that interrupted the download, or None if it completed.
+        """
+        try:
+            stream.stream_to_buffer(_PipeWriter(process.stdin))
+        except BrokenPipeError:
+            pass # ffmpeg exited early; its stderr explains why
+        except Exception as e:
+            return e
+        finally:
+            try:
+                process.stdin.close()
+            except BrokenPipeError:
+                pass
+
+    def _update_ffmpeg_progress(self, pbar, progress_pipe):
+        """Reads ffmpeg's -progress output, blocking until ffmpeg writes instead of polling."""
+        for raw_line in progress_pipe: # Ends at EOF, even if ffmpeg dies before progress=end
+            line = raw_line.decode('utf-8', errors='ignore')
+            if "progress=end" in line:
+                break
+            if "out_time_ms=" in line:
+                parts = line.split("=")
+                if len(parts) > 1:
+                    try:
+                        time_ms = int(parts[1])
+                        current_time_seconds = time_ms / 1_000_000
+                        pbar.update(current_time_seconds - pbar.n)
+                    except ValueError:
+                        pass # Ignore lines that don't have a valid time
 
     def _download_playlist(self, url: str):
         """Downloads all videos from a YouTube playlist."""
         try:
-            playlist_id = re.search(r"list=([a-zA-Z0-9_-]+)", url).group(1)
-            print("playlist_id: " + playlist_id)
-            playlist_url = f"https://www.youtube.com/playlist?list={playlist_id}"
-            pl = Playlist(playlist_url)
-            print(f"\nFound playlist: {pl.title}")
-            print(f"Downloading {len(pl.video_urls)} videos...")
-
-            for video_url in tqdm(pl.video_urls, desc="Playlist Progress"):
-                self._download_video(video_url)
-                sleep(1)
-
-            print("\nPlaylist download finished.")
+            if "list=" not in url:
+                raise ValueError(f"Not a playlist URL: {url}")
+            pl = _pytubefix().Playlist(url) # Playlist extracts the list id from any URL carrying one
+            _log("playlist_id: " + pl.playlist_id)
+            _log(f"\nFound playlist: {pl.title}")
+            video_urls = pl.video_urls
+            _log(f"Downloading {len(video_urls)} videos...")
+
+            # Metadata for the next video is fetched while the current ones download
+            ready = queue.Queue(maxsize=1)
+            prefetch_thread = threading.Thread(target=self._prefetch_videos, args=(video_urls, ready), daemon=True)
+            prefetch_thread.start()
+
+            # A video is only taken off the queue once a worker is free, so prefetching stays one item ahead
+            free_workers = threading.Semaphore(self.max_parallel)
+
+            # self.path and self.mode are treated as read-only while the pool is running
+            with tqdm(total=len(video_urls), desc="Playlist Progress") as pbar, \
+                    ThreadPoolExecutor(max_workers=self.max_parallel) as executor:
+                def on_done(_future):
+                    free_workers.release()
+                    # Runs on pool threads; tqdm's counter isn't atomic, so serialize with other output
+                    with _PRINT_LOCK:
+                        pbar.update(1)
+
+                while True:
+                    free_workers.acquire()
+                    video = ready.get()
+                    if video is None:
+                        break
+                    executor.submit(self._download_video, video, show_progress=False).add_done_callback(on_done)
+
+            _log("\nPlaylist download finished.")
         except Exception as err:
-            print(f"Error processing playlist: {err}")
+            _log(f"Error processing playlist: {err}")
+
+    def _prefetch_videos(self, video_urls, ready: queue.Queue):
+        """Feeds YouTube objects with their metadata already loaded into `ready`, then a None sentinel."""
+        try:
+            pytubefix = _pytubefix()
+
+            for video_url in video_urls:
+                try:
+                    yt = pytubefix.YouTube(video_url) # No per-stream bar; see _download_video
+                    yt.title # Forces the player response fetch
+                    ready.put(yt)
+                except Exception:
+                    ready.put(video_url) # Let _download_video report the failure for this item
+        finally:
+            ready.put(None)
 
     def _print_instructions(self):
         print("\nCommands:")
         print("  - Enter a YouTube URL to download.")
+        print("  - Enter a playlist URL (youtube.com/playlist?list=...) to download the whole playlist.")
         print("  - '/video' to switch to video download mode.")
         print("  - '/sound' to switch to sound download mode (default). ")
         print("  - '/exit' to quit the program.")
@@ -248,7 +418,10 @@ class YouTubeDownloader:
                 continue
 
             link = user_input
-            self._download_video(link)
+            if _is_playlist_url(link):
+                self._download_playlist(link)
+            else:
+                self._download_video(link)
 
             print(f"\nCurrent mode: {'Video' if self.mode == 'V' else 'Sound'}")
 